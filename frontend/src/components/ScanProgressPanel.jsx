@@ -53,6 +53,8 @@ export default function ScanProgressPanel() {
         return 'status-completed';
       case 'error':
         return 'status-error';
+      case 'skipped':
+        return 'status-skipped';
       default:
         return '';
     }
@@ -95,6 +97,7 @@ export default function ScanProgressPanel() {
                           {scan.status === 'analyzing' && '⚡ Analyzing'}
                           {scan.status === 'completed' && '✓ Completed'}
                           {scan.status === 'error' && '⚠ Error'}
+                          {scan.status === 'skipped' && '⏭ Skipped'}
                           {!scan.status && 'Pending'}
                         </span>
                       </td>
@@ -1,14 +1,31 @@
 import os
 import json
-import uuid
+import hashlib
 import subprocess
 import logging
+import re
+import multiprocessing
 import shutil
 import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
 from pathlib import Path
+from queue import Empty, PriorityQueue, Queue
 from urllib.parse import quote as url_quote
 from flask import Flask, request, jsonify
-from flask_cors import CORS
+from rule_keywords import get_rule_keywords
+import ijson
+import orjson
+import yaml
+
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
 
 # Configure the logger
 logging.basicConfig(
@@ -20,18 +37,93 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)  # Use the module name as the logger name
 
 app = Flask(__name__)
-CORS(app)
 
 # Constants
-TEMP_DIR = os.path.join(os.getcwd(), 'temp_sast')
+# Keep temp files in memory when tmpfs is available
+TEMP_DIR = os.environ.get('SAST_TMPDIR', '/dev/shm/sast_temp' if os.path.isdir('/dev/shm') else os.path.join(os.getcwd(), 'temp_sast'))
 RULES_DIR = os.path.join(os.getcwd(), 'semgrep-rules')
 MAX_SAST_FINDINGS = 500
 MAX_SCANNING_ITEMS = 20
+SCANNING_ITEM_TTL = 2.0  # Seconds a finished scan stays in the scanning list
+CPU_COUNT = max(1, os.cpu_count() or 1)
+ANALYSIS_WORKERS = int(os.environ.get('SAST_ANALYSIS_WORKERS', CPU_COUNT))
+# Split the cores between the analysis workers, each of which runs its own semgrep
+SEMGREP_JOBS = int(os.environ.get('SEMGREP_JOBS', max(1, CPU_COUNT // ANALYSIS_WORKERS)))
+SEMGREP_TIMEOUT = int(os.environ.get('SEMGREP_TIMEOUT', 10))
+SEMGREP_MAX_MEMORY = int(os.environ.get('SEMGREP_MAX_MEMORY', 1024))
+ANALYSIS_TIMEOUT = int(os.environ.get('SAST_ANALYSIS_TIMEOUT', 60))
+MIN_SCAN_BYTES = 64
+MAX_SCAN_BYTES = int(os.environ.get('SAST_MAX_SCAN_BYTES', 2000000))
+MAX_AVERAGE_LINE_LENGTH = 500
+STDIN_FAILURE_LIMIT = 3
+FINDINGS_CACHE_SIZE = int(os.environ.get('SEMGREP_RESULTS_CACHE_SIZE', 1024))
+SEMGREP_LSP_TIMEOUT = int(os.environ.get('SEMGREP_LSP_TIMEOUT', 30))
 
 # In-memory storage
-sast_findings = []
-sast_scanning = []
+# Writers hold state_lock and republish the immutable snapshots, readers use the snapshots without locking
+state_lock = threading.Lock()
+sast_findings = deque(maxlen=MAX_SAST_FINDINGS)
+sast_scanning = OrderedDict()  # Scanning items keyed by URL, oldest first
+findings_snapshot = ()
+scanning_snapshot = ()
+scanning_removals = PriorityQueue()  # (deadline, url) pairs for the reaper thread
 semgrep_initialized = False
+rulesets_cache = {}
+semgrep_stdin_supported = True
+semgrep_stdin_failures = 0  # Consecutive scans that failed on stdin but worked from a temp file
+# Findings keyed by body hash, extension and content kind, most recently used last
+findings_cache = OrderedDict()
+findings_cache_lock = threading.Lock()
+prefilters = {}
+findings_response_cache = (None, b'')  # (findings snapshot, serialized /api/sast/findings body)
+# Each analysis worker starts one language server per file extension it scans, loaded with just that
+# extension's rule sets, so with SEMGREP_LSP on expect up to workers x extensions resident semgrep processes
+semgrep_lsp_enabled = os.environ.get('SEMGREP_LSP', 'false').lower() == 'true'
+semgrep_lsp_servers = {}
+
+# Worker processes for the analysis itself, created on first use by get_analysis_executor
+analysis_executor = None
+analysis_executor_lock = threading.Lock()
+
+# Content type keywords mapped to the file extension used for semgrep, checked in order
+CONTENT_TYPE_EXTENSIONS = (
+    ('html', '.html'),
+    ('javascript', '.js'),
+    ('json', '.json'),
+    ('php', '.php'),
+    ('python', '.py')
+)
+URL_SUFFIX_EXTENSIONS = ('.js', '.php', '.py')
+
+# Used to sniff the file type from the start of the content
+SNIFF_LENGTH = 512
+HTML_PREFIXES = ('<!doctype html', '<html', '<head', '<body')
+JS_KEYWORD_RE = re.compile(r'\b(?:function|const|var|let)\s|=>')
+
+# Content type keywords mapped to the file type shown in the scanning list, checked in order
+CONTENT_TYPE_FILE_TYPES = (
+    ('html', 'HTML'),
+    ('javascript', 'JavaScript'),
+    ('json', 'JSON'),
+    ('xml', 'XML'),
+    ('css', 'CSS')
+)
+
+# LSP diagnostic severities mapped back to semgrep severities
+LSP_SEVERITIES = {
+    1: 'ERROR',
+    2: 'WARNING',
+    3: 'INFO',
+    4: 'INFO'
+}
+
+# Semgrep rules directory for each supported file extension
+RULESET_LANGUAGES = {
+    '.js': 'javascript',
+    '.html': 'html',
+    '.php': 'php',
+    '.py': 'python'
+}
 
 
 def initialize_semgrep():
@@ -51,6 +143,10 @@ def initialize_semgrep():
         except (subprocess.SubprocessError, FileNotFoundError):
             logger.info('Semgrep not found, FATAL!')
 
+        # Resolve rule sets up front so requests don't have to walk the rules tree
+        for extension in RULESET_LANGUAGES:
+            get_rulesets(extension)
+
         logger.info(f'Semgrep initialization {"complete" if semgrep_initialized else "failed, using legacy analysis only"}')
     except Exception as e:
         logger.info(f'Error initializing semgrep: {str(e)}')
@@ -58,10 +154,449 @@ def initialize_semgrep():
         semgrep_initialized = False
 
 
-def run_semgrep_analysis(content, url, method, host, content_type, timestamp):
+def initialize_analysis_worker(initialized):
+    """
+    Set up an analysis worker process, the only place semgrep actually runs
+    The serving process already checked semgrep is installed, so that isn't repeated here
+    """
+    global semgrep_initialized
+
+    semgrep_initialized = initialized
+    if not semgrep_initialized:
+        return
+
+    for extension in RULESET_LANGUAGES:
+        # The prefilter is only an optimization, it must never turn semgrep off
+        try:
+            build_prefilter(extension)
+        except Exception as e:
+            prefilters.pop(extension, None)
+            logger.info(f'Error building prefilter for {extension}, scanning without it: {str(e)}')
+
+
+def get_analysis_executor():
+    """
+    Get the analysis process pool, creating it on first use
+    Workers are spawned rather than forked since gunicorn serves requests on several threads
+    """
+    global analysis_executor
+
+    with analysis_executor_lock:
+        if analysis_executor is None:
+            analysis_executor = ProcessPoolExecutor(max_workers=ANALYSIS_WORKERS,
+                                                    mp_context=multiprocessing.get_context('spawn'),
+                                                    initializer=initialize_analysis_worker,
+                                                    initargs=(semgrep_initialized,))
+        return analysis_executor
+
+
+def discard_analysis_executor(executor):
+    """Drop a broken process pool so the next scan gets a new one"""
+    global analysis_executor
+
+    with analysis_executor_lock:
+        if analysis_executor is executor:
+            analysis_executor = None
+    executor.shutdown(wait=False)
+
+
+def run_analysis(*args):
+    """
+    Run scan_content in the process pool and wait for the findings
+    A pool whose worker died (e.g. OOM killed) is replaced, so one crash doesn't stop all later scans
+    """
+    executor = get_analysis_executor()
+    try:
+        future = executor.submit(scan_content, *args)
+    except BrokenProcessPool:
+        # The pool broke during an earlier scan, this one can still run on a new pool
+        logger.info('Analysis pool is broken, starting a new one')
+        discard_analysis_executor(executor)
+        executor = get_analysis_executor()
+        future = executor.submit(scan_content, *args)
+
+    try:
+        return future.result(timeout=ANALYSIS_TIMEOUT)
+    except BrokenProcessPool:
+        # A worker died on this scan, fail it rather than risk killing the next pool too
+        logger.info('Analysis worker died, starting a new pool')
+        discard_analysis_executor(executor)
+        raise
+
+
+def get_rulesets(extension):
+    """
+    Get the rule set directories for a file extension
+    Results are cached since the rules tree doesn't change while the service is running
+    """
+    if extension in rulesets_cache:
+        return rulesets_cache[extension]
+
+    rulesets = []
+    language = RULESET_LANGUAGES.get(extension)
+    if language:
+        path = f"{RULES_DIR}/{language}"
+        try:
+            with os.scandir(path) as entries:
+                rulesets = sorted(entry.path for entry in entries if entry.is_dir())
+        except OSError as e:
+            logger.info(f'Error reading rules directory {path}: {str(e)}')
+            # Don't cache a missing rules directory, it may still be populated later
+            return []
+
+        # Keep the security rule set first
+        security_path = os.path.join(path, 'security')
+        if security_path in rulesets:
+            rulesets.remove(security_path)
+            rulesets.insert(0, security_path)
+
+    rulesets_cache[extension] = rulesets
+    return rulesets
+
+
+def build_prefilter(extension):
+    """
+    Build a keyword matcher from the rules for a file extension
+    Content that contains none of the keywords can't match any rule, so semgrep doesn't need to run
+    """
+    keywords = set()
+    for ruleset in get_rulesets(extension):
+        for root, _, files in os.walk(ruleset):
+            for file in files:
+                if not file.endswith(('.yaml', '.yml')):
+                    continue
+                try:
+                    with open(os.path.join(root, file), encoding='utf-8') as f:
+                        rules = (yaml.safe_load(f) or {}).get('rules') or []
+                except (OSError, yaml.YAMLError, AttributeError) as e:
+                    logger.info(f'Error reading rule file {file}, prefilter disabled for {extension}: {str(e)}')
+                    return
+                for rule in rules:
+                    rule_keywords = get_rule_keywords(rule)
+                    if rule_keywords is None:
+                        logger.info(f'Rule {rule.get("id") if isinstance(rule, dict) else file} can\'t be prefiltered, prefilter disabled for {extension}')
+                        return
+                    keywords |= rule_keywords
+
+    if not keywords:
+        return
+
+    keywords = sorted(keywords)
+    if hyperscan:
+        database = hyperscan.Database(mode=hyperscan.HS_MODE_BLOCK)
+        database.compile(
+            expressions=[re.escape(keyword).encode() for keyword in keywords],
+            ids=list(range(len(keywords))),
+            elements=len(keywords),
+            flags=[hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_SINGLEMATCH] * len(keywords)
+        )
+        prefilters[extension] = database
+    else:
+        prefilters[extension] = re.compile('|'.join(re.escape(keyword) for keyword in keywords), re.IGNORECASE)
+    logger.info(f'Prefilter for {extension} built with {len(keywords)} keywords')
+
+
+def prefilter_matches(extension, content):
+    """Check whether the content contains any keyword from the rules, always true without a prefilter"""
+    prefilter = prefilters.get(extension)
+    if prefilter is None:
+        return True
+
+    if hyperscan:
+        matches = []
+
+        def on_match(keyword_id, *args):
+            matches.append(keyword_id)
+            # One hit is enough, stop scanning
+            return True
+
+        try:
+            prefilter.scan(content.encode('utf-8', 'replace'), match_event_handler=on_match)
+        except hyperscan.ScanTerminated:
+            pass
+        return bool(matches)
+    return prefilter.search(content) is not None
+
+
+def stream_semgrep_results(command, content=None):
+    """
+    Run a semgrep command, optionally feeding content through stdin
+    The results array is streamed out of semgrep's JSON output one finding at a time,
+    so the full output is never held in memory
+    Raises CalledProcessError if semgrep fails
+    """
+    with tempfile.TemporaryFile() as stderr:
+        with subprocess.Popen(command,
+                              stdin=subprocess.DEVNULL if content is None else subprocess.PIPE,
+                              stdout=subprocess.PIPE,
+                              stderr=stderr) as process:
+            if content is not None:
+                try:
+                    process.stdin.write(content.encode('utf-8', 'replace'))
+                    process.stdin.close()
+                except BrokenPipeError:
+                    # Semgrep exited without reading the content, the return code says why
+                    pass
+            results, parse_error = [], None
+            try:
+                results = list(ijson.items(process.stdout, 'results.item', use_float=True))
+            except ijson.JSONError as e:
+                parse_error = e
+            # Let semgrep finish writing even if its output couldn't be parsed
+            process.stdout.read()
+            process.wait()
+
+        if process.returncode != 0:
+            stderr.seek(0)
+            raise subprocess.CalledProcessError(process.returncode, command,
+                                                stderr=stderr.read().decode('utf-8', 'replace'))
+        if parse_error:
+            raise parse_error
+
+    return results
+
+
+class SemgrepLspError(Exception):
+    """Raised when the semgrep language server fails or doesn't answer in time"""
+
+
+class SemgrepLanguageServer:
+    """
+    A long-lived `semgrep lsp` process that keeps the rules loaded between scans
+    Content is scanned by opening it as a document and waiting for the published diagnostics
+    """
+
+    def __init__(self, rulesets):
+        self.lock = threading.Lock()
+        self.messages = Queue()
+        self.next_id = 1
+        self.process = subprocess.Popen(['semgrep', 'lsp'], stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        threading.Thread(target=self.read_messages, name='semgrep-lsp-reader', daemon=True).start()
+
+        try:
+            root_uri = Path(TEMP_DIR).as_uri()
+            self.request('initialize', {
+                'processId': os.getpid(),
+                'rootUri': root_uri,
+                'workspaceFolders': [{'uri': root_uri, 'name': 'sast'}],
+                'capabilities': {},
+                'initializationOptions': {
+                    'scan': {
+                        'configuration': rulesets,
+                        'exclude': [],
+                        'include': [],
+                        'jobs': SEMGREP_JOBS,
+                        'maxMemory': SEMGREP_MAX_MEMORY,
+                        'maxTargetBytes': MAX_SCAN_BYTES,
+                        'onlyGitDirty': False,
+                        'ci': False
+                    },
+                    'metrics': {'enabled': False}
+                }
+            })
+            self.notify('initialized', {})
+        except Exception:
+            # Don't leak the server process (and its reader thread) when it never came up
+            self.close()
+            raise
+
+    def read_messages(self):
+        """Read JSON-RPC messages from the server into the message queue"""
+        stdout = self.process.stdout
+        while True:
+            content_length = None
+            while True:
+                line = stdout.readline()
+                if not line:
+                    self.messages.put(None)
+                    return
+                line = line.strip()
+                if not line:
+                    break
+                name, _, value = line.decode('ascii', 'replace').partition(':')
+                if name.lower() == 'content-length':
+                    content_length = int(value)
+            if content_length is not None:
+                self.messages.put(json.loads(stdout.read(content_length)))
+
+    def send(self, message):
+        body = json.dumps(dict(message, jsonrpc='2.0')).encode('utf-8')
+        try:
+            self.process.stdin.write(f'Content-Length: {len(body)}\r\n\r\n'.encode('ascii') + body)
+            self.process.stdin.flush()
+        except OSError as e:
+            raise SemgrepLspError(f'Error writing to semgrep language server: {str(e)}')
+
+    def notify(self, method, params):
+        self.send({'method': method, 'params': params})
+
+    def request(self, method, params):
+        request_id = self.next_id
+        self.next_id += 1
+        self.send({'id': request_id, 'method': method, 'params': params})
+        return self.wait_for(lambda message: message.get('id') == request_id and 'method' not in message)
+
+    def wait_for(self, predicate):
+        """Wait for the first message matching predicate, skipping everything else"""
+        deadline = time.monotonic() + SEMGREP_LSP_TIMEOUT
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise SemgrepLspError('Timed out waiting for semgrep language server')
+            try:
+                message = self.messages.get(timeout=remaining)
+            except Empty:
+                continue
+            if message is None:
+                raise SemgrepLspError('Semgrep language server exited')
+            if predicate(message):
+                if 'error' in message:
+                    raise SemgrepLspError(f"Semgrep language server error: {message['error']}")
+                return message
+
+    def scan(self, content, extension):
+        """Scan content and return the findings in the same shape as semgrep's JSON results"""
+        with self.lock, tempfile.NamedTemporaryFile(mode='w', encoding='utf-8', errors='replace',
+                                                    dir=TEMP_DIR, suffix=extension, delete=True) as f:
+            f.write(content)
+            f.flush()
+            uri = Path(f.name).as_uri()
+            self.notify('textDocument/didOpen', {
+                'textDocument': {
+                    'uri': uri,
+                    'languageId': RULESET_LANGUAGES.get(extension, 'plaintext'),
+                    'version': 1,
+                    'text': content
+                }
+            })
+            try:
+                message = self.wait_for(lambda message: message.get('method') == 'textDocument/publishDiagnostics'
+                                        and message['params'].get('uri') == uri)
+            finally:
+                self.notify('textDocument/didClose', {'textDocument': {'uri': uri}})
+
+        lines = content.splitlines()
+        results = []
+        for diagnostic in message['params'].get('diagnostics', []):
+            start_line = diagnostic['range']['start']['line'] + 1
+            end_line = diagnostic['range']['end']['line'] + 1
+            results.append({
+                'check_id': str(diagnostic.get('code', '')),
+                'path': f.name,
+                'start': {'line': start_line},
+                'end': {'line': end_line},
+                'extra': {
+                    'message': diagnostic.get('message', ''),
+                    'severity': LSP_SEVERITIES.get(diagnostic.get('severity'), 'INFO'),
+                    'lines': '\n'.join(lines[start_line - 1:end_line])
+                }
+            })
+        return results
+
+    def close(self):
+        """Kill the server, which also ends the reader thread once stdout closes"""
+        try:
+            self.process.kill()
+            self.process.wait()
+        except OSError:
+            pass
+
+
+def get_semgrep_lsp(extension, rulesets):
+    """
+    Get the semgrep language server for a file extension, starting it on first use
+    Each server only loads that extension's rule sets so it reports the same findings as the semgrep CLI
+    """
+    if extension not in semgrep_lsp_servers:
+        logger.info(f'Starting semgrep language server for {extension}')
+        semgrep_lsp_servers[extension] = SemgrepLanguageServer(rulesets)
+    return semgrep_lsp_servers[extension]
+
+
+def run_semgrep(rulesets, content, extension):
+    """
+    Run semgrep once with every applicable rule set so the target is only parsed once
+    Uses the semgrep language server when enabled, otherwise the content is piped through stdin,
+    falling back to a temp file if semgrep can't read it
+    Returns semgrep's results
+    """
+    global semgrep_stdin_supported, semgrep_stdin_failures, semgrep_lsp_enabled
+
+    if semgrep_lsp_enabled:
+        try:
+            return get_semgrep_lsp(extension, rulesets).scan(content, extension)
+        except (SemgrepLspError, OSError, ValueError) as e:
+            # Go back to one semgrep process per scan rather than retrying a broken server
+            logger.info(f'Semgrep language server failed, falling back to the semgrep CLI: {str(e)}')
+            for server in semgrep_lsp_servers.values():
+                server.close()
+            semgrep_lsp_servers.clear()
+            semgrep_lsp_enabled = False
+
+    command = [
+        'semgrep', '--json', '--metrics=off',
+        '--jobs', str(SEMGREP_JOBS),
+        '--timeout', str(SEMGREP_TIMEOUT),
+        '--max-memory', str(SEMGREP_MAX_MEMORY),
+        '--max-target-bytes', str(MAX_SCAN_BYTES)
+    ]
+    for ruleset in rulesets:
+        command += ['--config', ruleset]
+
+    if not semgrep_stdin_supported:
+        return run_semgrep_on_temp_file(command, content, extension)
+
+    try:
+        results = stream_semgrep_results(command + ['--scan-unknown-extensions', '-'], content)
+        semgrep_stdin_failures = 0
+        return results
+    except subprocess.CalledProcessError as e:
+        logger.info(f'Semgrep failed to scan from stdin, retrying with a temp file: {e.stderr}')
+
+    # Rule errors and the like fail on the temp file as well and are raised from here
+    results = run_semgrep_on_temp_file(command, content, extension)
+
+    # Only the stdin target failed. Once that keeps happening semgrep can't read '-', so stop trying it
+    semgrep_stdin_failures += 1
+    if semgrep_stdin_failures >= STDIN_FAILURE_LIMIT:
+        logger.info('Semgrep keeps failing to scan from stdin, using temp files from now on')
+        semgrep_stdin_supported = False
+    return results
+
+
+def run_semgrep_on_temp_file(command, content, extension):
+    """Run a semgrep command on the content written to a temp file"""
+    with tempfile.NamedTemporaryFile(mode='w', encoding='utf-8', errors='replace', dir=TEMP_DIR,
+                                     suffix=extension, delete=True) as f:
+        f.write(content)
+        f.flush()
+        return stream_semgrep_results(command + [f.name])
+
+
+def get_semgrep_results(rulesets, content, extension, url):
+    """
+    Get the raw semgrep results for the content
+    Returns None if semgrep failed
+    """
+    try:
+        results = run_semgrep(rulesets, content, extension)
+    except subprocess.SubprocessError as e:
+        logger.info(f'Error running semgrep for {url}: {str(e)}')
+        return None
+    except ijson.JSONError:
+        logger.info('Error parsing semgrep results')
+        return None
+
+    logger.info(f"Semgrep scan completed for {url} with {len(results)} findings")
+    return results
+
+
+def run_semgrep_analysis(content, url, method, host, content_type, timestamp, extension=None):
     """
     Run semgrep analysis on the content
-    Returns an array of findings
+    The file extension is worked out from the content and content type unless it's given
+    Returns an array of findings, or None if semgrep failed
     """
     global semgrep_initialized
 
@@ -73,124 +608,60 @@ def run_semgrep_analysis(content, url, method, host, content_type, timestamp):
 
     try:
         findings = []
-        file_id = str(uuid.uuid4())
-        extension = '.txt'
-
-        # Determine file extension based on content type
-        if 'html' in content_type:
-            extension = '.html'
-        elif 'javascript' in content_type:
-            extension = '.js'
-        elif 'json' in content_type:
-            extension = '.json'
-        elif 'php' in content_type:
-            extension = '.php'
-        elif 'python' in content_type:
-            extension = '.py'
-        elif url.endswith('.js'):
-            extension = '.js'
-        elif url.endswith('.php'):
-            extension = '.php'
-        elif url.endswith('.py'):
-            extension = '.py'
-
-        temp_file_path = os.path.join(TEMP_DIR, f"{file_id}{extension}")
+
+        # Determine file extension based on the content, falling back to the content type
+        if not extension:
+            content_type_extension = get_extension(content_type, get_url_suffix(url))
+            extension = sniff_extension(content, content_type_extension) or content_type_extension
+
         logger.info(f'Processing file {url} with extension {extension}')
 
-        # Write content to temp file
-        with open(temp_file_path, 'w') as f:
-            f.write(content)
-        logger.info(f"File {url} written to temp file {temp_file_path}")
         # Determine which rule sets to use based on file type
-        rulesets = []
-        if extension in ['.js']:
-            path = f"{RULES_DIR}/javascript"
-            rulesets = [
-                f"{path}/security",
-            ]
-            for item in os.listdir(path):
-                item_path = os.path.join(path, item)
-                if os.path.isdir(item_path):
-                    rulesets.append(item_path)
-        elif extension == '.html':
-            path = f"{RULES_DIR}/html"
-            rulesets = [
-                f"{path}/security",
-            ]
-            for item in os.listdir(path):
-                item_path = os.path.join(path, item)
-                if os.path.isdir(item_path):
-                    rulesets.append(item_path)
-        elif extension == '.php':
-            path = f"{RULES_DIR}/php"
-            rulesets = [
-                f"{path}/security",
-            ]
-            for item in os.listdir(path):
-                item_path = os.path.join(path, item)
-                if os.path.isdir(item_path):
-                    rulesets.append(item_path)
-        elif extension == '.py':
-            path = f"{RULES_DIR}/python"
-            rulesets = [
-                f"{path}/security",
-            ]
-            for item in os.listdir(path):
-                item_path = os.path.join(path, item)
-                if os.path.isdir(item_path):
-                    rulesets.append(item_path)
+        rulesets = get_rulesets(extension)
 
         # Only proceed if we have applicable rule sets
         if rulesets:
             logger.info(f"Applicable rule sets found for {url}: {rulesets}")
-            # Run semgrep with appropriate rule sets
-            for ruleset in rulesets:
-                if os.path.exists(ruleset):
-                    logger.info(f"Running semgrep with ruleset {ruleset} for {url}")
-                    try:
-                        command = ['semgrep', '--config', ruleset, temp_file_path, '--json']
-                        result = subprocess.run(command, capture_output=True, text=True, check=True)
-                        # Parse results
-                        try:
-                            semgrep_results = json.loads(result.stdout)
-                            logger.info(f"Semgrep scan completed for {url} with {len(semgrep_results['results'])} findings") #TODO remove this later
-                            if 'results' in semgrep_results and isinstance(semgrep_results['results'], list):
-                                for finding in semgrep_results['results']:
-                                    findings.append({
-                                        'type': finding['check_id'].split('.')[-1].upper(),
-                                        'cveId': f"[SEMGREP-{finding['check_id']}]",
-                                        'severity': map_semgrep_severity_to_sast_severity(finding['extra']['severity']),
-                                        'title': finding['extra']['message'],
-                                        'url': url,
-                                        'tech': extension[1:].upper(),
-                                        'version': host or '',
-                                        'indicator': finding['extra']['lines'],
-                                        'method': method,
-                                        'at': timestamp,
-                                        'source': 'SEMGREP',
-                                        'details': {
-                                            'rule': finding['check_id'],
-                                            'path': finding['path'],
-                                            'startLine': finding['start']['line'],
-                                            'endLine': finding['end']['line']
-                                        }
-                                    })
-                        except json.JSONDecodeError:
-                            logger.info('Error parsing semgrep results')
-                    except subprocess.SubprocessError as e:
-                        logger.info(f'Error running semgrep with ruleset {ruleset}: {str(e)}')
+            if not prefilter_matches(extension, content):
+                logger.info(f'No rule keywords found in {url}, skipping semgrep')
+                return findings
+            # Values that are the same for every finding are looked up once, outside the loop
+            tech = extension[1:].upper()
+            version = host or ''
+            map_severity = map_semgrep_severity_to_sast_severity
+            add_finding = findings.append
+            results = get_semgrep_results(rulesets, content, extension, url)
+            if results is None:
+                return None
+            for finding in results:
+                check_id = finding['check_id']
+                extra = finding['extra']
+                add_finding({
+                    'type': check_id.rpartition('.')[2].upper(),
+                    'cveId': f"[SEMGREP-{check_id}]",
+                    'severity': map_severity(extra['severity']),
+                    'title': extra['message'],
+                    'url': url,
+                    'tech': tech,
+                    'version': version,
+                    'indicator': extra['lines'],
+                    'method': method,
+                    'at': timestamp,
+                    'source': 'SEMGREP',
+                    'details': {
+                        'rule': check_id,
+                        'path': finding['path'],
+                        'startLine': finding['start']['line'],
+                        'endLine': finding['end']['line']
+                    }
+                })
         else:
             logger.info(f"No applicable rule sets found for {url}")
-        # Clean up temp file
-        try:
-            os.unlink(temp_file_path)
-        except OSError:
-            logger.info('Error removing temporary file')
 
         return findings
     except Exception as e:
         logger.info(f'Error in run_semgrep_analysis: {str(e)}')
-        return []
+        return None
 
 
 def map_semgrep_severity_to_sast_severity(semgrep_severity):
@@ -232,72 +703,217 @@ def analyze_generic(text, url, host, path, method, timestamp):
 
 def get_file_type_from_content_type(headers):
     """Get file type from content type"""
-    content_type = str(headers.get('content-type', '')).lower()
-
-    if 'html' in content_type:
-        return 'HTML'
-    if 'javascript' in content_type:
-        return 'JavaScript'
-    if 'json' in content_type:
-        return 'JSON'
-    if 'xml' in content_type:
-        return 'XML'
-    if 'css' in content_type:
-        return 'CSS'
+    return get_file_type(str(headers.get('content-type', '')).lower())
 
+
+@lru_cache(maxsize=1024)
+def get_file_type(content_type):
+    """Get file type for a lowercased content type"""
+    for keyword, file_type in CONTENT_TYPE_FILE_TYPES:
+        if keyword in content_type:
+            return file_type
     return 'Unknown'
 
 
+def get_url_suffix(url):
+    """Get the file extension a URL ends with, if it's one semgrep has rules for"""
+    for suffix in URL_SUFFIX_EXTENSIONS:
+        if url.endswith(suffix):
+            return suffix
+    return ''
+
+
+@lru_cache(maxsize=1024)
+def get_extension(content_type, url_suffix):
+    """Get the file extension used for semgrep from a lowercased content type, falling back to the URL suffix"""
+    for keyword, extension in CONTENT_TYPE_EXTENSIONS:
+        if keyword in content_type:
+            return extension
+    return url_suffix or '.txt'
+
+
+def sniff_extension(text, content_type_extension):
+    """
+    Get the file extension from the start of the content, or None if it's not clear
+    Only the first SNIFF_LENGTH characters are looked at. JSON and JavaScript are only guessed
+    when the content type didn't give a code file type already, since JS can start with { or [ too
+    """
+    head = text[:SNIFF_LENGTH].lstrip('\ufeff \t\r\n')
+    lowered = head.lower()
+
+    if lowered.startswith(HTML_PREFIXES):
+        return '.html'
+    if lowered.startswith('<?php'):
+        return '.php'
+    if content_type_extension in ('.txt', '.json') and head.startswith(('{', '[')):
+        return '.json'
+    if (content_type_extension == '.txt' and not head.startswith('<') and
+            head.count(';') >= 2 and JS_KEYWORD_RE.search(head)):
+        return '.js'
+    return None
+
+
+@lru_cache(maxsize=1024)
+def get_content_kind(content_type, is_js_url):
+    """Get whether a lowercased content type is HTML, JavaScript and text, as an (is_html, is_js, is_text) tuple"""
+    is_html = 'html' in content_type
+    is_js = ('javascript' in content_type or
+             'application/json' in content_type or
+             'application/x-javascript' in content_type or
+             is_js_url)
+    is_text = ('text' in content_type or
+               is_html or
+               is_js or
+               'xml' in content_type)
+    return is_html, is_js, is_text
+
+
 def add_scanning_item(item):
     """Add an item to the scanning list"""
-    global sast_scanning, MAX_SCANNING_ITEMS
+    global sast_scanning, MAX_SCANNING_ITEMS, scanning_snapshot
 
     if not item or 'url' not in item:
-        return sast_scanning
+        return scanning_snapshot
 
-    # Remove existing item with the same URL if present
-    sast_scanning = [scan for scan in sast_scanning if scan['url'] != item['url']]
+    with state_lock:
+        # Remove existing item with the same URL if present, so the new one moves to the end
+        sast_scanning.pop(item['url'], None)
 
-    # Add new item
-    sast_scanning.append(item)
+        # Add new item
+        sast_scanning[item['url']] = item
 
-    # Ensure we don't exceed the maximum
-    if len(sast_scanning) > MAX_SCANNING_ITEMS:
-        sast_scanning.pop(0)
+        # Ensure we don't exceed the maximum
+        if len(sast_scanning) > MAX_SCANNING_ITEMS:
+            sast_scanning.popitem(last=False)
 
-    return sast_scanning
+        scanning_snapshot = tuple(sast_scanning.values())
+        return scanning_snapshot
 
 
 def update_scanning_item_status(url, status):
     """Update the status of a scanning item"""
-    global sast_scanning
-
-    for i, item in enumerate(sast_scanning):
-        if item['url'] == url:
-            sast_scanning[i]['status'] = status
-            break
+    global sast_scanning, scanning_snapshot
 
-    return sast_scanning
+    with state_lock:
+        if url in sast_scanning:
+            # Replace rather than mutate the item, it may be part of a published snapshot
+            sast_scanning[url] = dict(sast_scanning[url], status=status)
+            scanning_snapshot = tuple(sast_scanning.values())
+        return scanning_snapshot
 
 
 def remove_scanning_item(url):
     """Remove an item from the scanning list"""
-    global sast_scanning
-    sast_scanning = [item for item in sast_scanning if item['url'] != url]
-    return sast_scanning
+    global sast_scanning, scanning_snapshot
+
+    with state_lock:
+        if sast_scanning.pop(url, None) is not None:
+            scanning_snapshot = tuple(sast_scanning.values())
+        return scanning_snapshot
+
+
+def reap_scanning_items():
+    """Remove scanning items once their deadline passes, runs on a single background thread"""
+    while True:
+        deadline, url = scanning_removals.get()
+        delay = deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        remove_scanning_item(url)
 
 
 def add_sast_findings(items):
     """Add findings to the collection"""
-    global sast_findings, MAX_SAST_FINDINGS
+    global sast_findings, MAX_SAST_FINDINGS, findings_snapshot
 
     if not isinstance(items, list) or not items:
         return
 
-    for item in items:
-        sast_findings.append(item)
-        if len(sast_findings) > MAX_SAST_FINDINGS:
-            sast_findings.pop(0)
+    with state_lock:
+        # The deque drops the oldest findings once MAX_SAST_FINDINGS is reached
+        sast_findings.extend(items)
+        findings_snapshot = tuple(sast_findings)
+
+
+def to_text(body):
+    """Get the body as text, without copying it when it's already a string"""
+    if isinstance(body, str):
+        return body
+    if isinstance(body, (bytes, bytearray)):
+        return body.decode('utf-8', 'replace')
+    return str(body) if body else ''
+
+
+def get_skip_reason(text):
+    """Get the reason the content shouldn't be analyzed, or None if it should"""
+    # Sizes are in encoded bytes, the same way semgrep's --max-target-bytes counts them.
+    # A character takes 1 to 4 UTF-8 bytes, so the body is only encoded when that range straddles a limit
+    length = len(text)
+    if length > MAX_SCAN_BYTES:
+        return f'body too large (over {MAX_SCAN_BYTES} bytes)'
+    if text.isascii() or (MIN_SCAN_BYTES <= length and length * 4 <= MAX_SCAN_BYTES):
+        size = length
+    else:
+        size = len(text.encode('utf-8', 'replace'))
+    if size < MIN_SCAN_BYTES:
+        return f'body too small ({size} bytes)'
+    if size > MAX_SCAN_BYTES:
+        return f'body too large ({size} bytes)'
+
+    average_line_length = len(text) / (text.count('\n') + 1)
+    if average_line_length > MAX_AVERAGE_LINE_LENGTH:
+        return f'body looks minified (average line length {int(average_line_length)})'
+
+    return None
+
+
+def scan_content(text, url, method, host, path, content_type, timestamp, is_html, is_js, extension):
+    """
+    Run semgrep and the legacy analysis on the content
+    Runs in a worker process, so it must not touch the scanning list or the findings collection
+    Returns the findings and whether semgrep succeeded, so failed scans aren't cached
+    """
+    findings = []
+
+    # First run semgrep analysis
+    logger.info(f'Starting semgrep analysis for URL: {url}')
+    semgrep_findings = run_semgrep_analysis(text, url, method, host, content_type, timestamp, extension)
+    findings.extend(semgrep_findings or [])
+
+    # Also run our legacy analysis as a fallback
+    # HTML analysis
+    if is_html:
+        findings.extend(analyze_html(text, url, host, path, method, timestamp))
+
+    # JavaScript analysis
+    if is_js or is_html:  # Also check for inline JS in HTML
+        findings.extend(analyze_javascript(text, url, host, path, method, timestamp))
+
+    # Generic analysis for all text files
+    findings.extend(analyze_generic(text, url, host, path, method, timestamp))
+
+    return findings, semgrep_findings is not None
+
+
+def get_cached_findings(cache_key, url, method, host, timestamp):
+    """Get cached findings for a body, updated for the current request, or None if it wasn't analyzed yet"""
+    with findings_cache_lock:
+        cached = findings_cache.get(cache_key)
+        if cached is None:
+            return None
+        findings_cache.move_to_end(cache_key)
+
+    # The cached findings may come from another URL, so swap in this request's details
+    return [dict(finding, url=url, method=method, version=host or '', at=timestamp) for finding in cached]
+
+
+def cache_findings(cache_key, findings):
+    """Cache the findings for a body, dropping the least recently used entry when full"""
+    with findings_cache_lock:
+        findings_cache[cache_key] = findings
+        findings_cache.move_to_end(cache_key)
+        if len(findings_cache) > FINDINGS_CACHE_SIZE:
+            findings_cache.popitem(last=False)
 
 
 def analyze_sast(record, body, headers=None):
@@ -311,7 +927,6 @@ def analyze_sast(record, body, headers=None):
         return []
 
     headers = headers or {}
-    findings = []
     url = record.get('url', '')
     method = record.get('method', '')
     host = record.get('host', '')
@@ -332,15 +947,18 @@ def analyze_sast(record, body, headers=None):
     logger.info(f'Added {url} to scanning list')
     try:
         content_type = str(headers.get('content-type', '')).lower()
-        is_html = 'html' in content_type
-        is_js = ('javascript' in content_type or
-                 'application/json' in content_type or
-                 'application/x-javascript' in content_type or
-                 url.endswith('.js'))
-        is_text = ('text' in content_type or
-                   is_html or
-                   is_js or
-                   'xml' in content_type)
+        text = to_text(body)
+        is_html, is_js, is_text = get_content_kind(content_type, url.endswith('.js'))
+
+        # Servers mislabel content, so trust the content itself when it's unambiguous
+        content_type_extension = get_extension(content_type, get_url_suffix(url))
+        extension = sniff_extension(text, content_type_extension)
+        if extension:
+            is_html = extension == '.html'
+            is_js = extension in ('.js', '.json')
+            is_text = True
+        else:
+            extension = content_type_extension
 
         if not is_text or not body:
             # Remove from scanning list if not text content
@@ -348,24 +966,25 @@ def analyze_sast(record, body, headers=None):
             remove_scanning_item(url)
             return []
 
-        text = str(body or '')
-
-        # First run semgrep analysis
-        logger.info(f'Starting semgrep analysis for URL: {url}')
-        semgrep_findings = run_semgrep_analysis(text, url, method, host, content_type, timestamp)
-        findings.extend(semgrep_findings)
-
-        # Also run our legacy analysis as a fallback
-        # HTML analysis
-        if is_html:
-            findings.extend(analyze_html(text, url, host, path, method, timestamp))
-
-        # JavaScript analysis
-        if is_js or is_html:  # Also check for inline JS in HTML
-            findings.extend(analyze_javascript(text, url, host, path, method, timestamp))
+        # Skip bodies too small to hold anything interesting, too large for semgrep, or minified bundles
+        skip_reason = get_skip_reason(text)
+        if skip_reason:
+            logger.info(f'Skipping analysis of {url}: {skip_reason}')
+            update_scanning_item_status(url, 'skipped')
+            return []
 
-        # Generic analysis for all text files
-        findings.extend(analyze_generic(text, url, host, path, method, timestamp))
+        # Identical bodies served from several URLs are only analyzed once
+        cache_key = (f"{hashlib.sha256(text.encode('utf-8', 'replace')).hexdigest()}:"
+                     f"{extension}:{int(is_html)}{int(is_js)}")
+        findings = get_cached_findings(cache_key, url, method, host, timestamp)
+        if findings is not None:
+            logger.info(f'Using cached findings for {url}')
+        else:
+            # Run the analysis in the process pool so concurrent scans don't queue up behind each other
+            findings, cacheable = run_analysis(text, url, method, host, path, content_type,
+                                               timestamp, is_html, is_js, extension)
+            if cacheable:
+                cache_findings(cache_key, findings)
 
         # Update scan status to completed
         update_scanning_item_status(url, 'completed')
@@ -382,28 +1001,26 @@ def analyze_sast(record, body, headers=None):
         return []
     finally:
         # After a timeout, remove from scanning list
-        import threading
-        threading.Timer(2.0, lambda: remove_scanning_item(url)).start()
+        scanning_removals.put((time.monotonic() + SCANNING_ITEM_TTL, url))
 
 
 def clear_all():
-    """Clear all findings and scanning items, also clean up temp directories"""
-    global sast_findings, sast_scanning
+    """
+    Clear all findings and scanning items
+    Temp files aren't touched, they belong to in-flight scans and remove themselves
+    """
+    global sast_findings, sast_scanning, findings_snapshot, scanning_snapshot
 
-    sast_findings = []
-    sast_scanning = []
+    with state_lock:
+        sast_findings.clear()
+        sast_scanning.clear()
+        findings_snapshot = ()
+        scanning_snapshot = ()
 
-    # Clean up temp directory
-    try:
-        if os.path.exists(TEMP_DIR):
-            # Remove all files in the temp directory
-            for file in os.listdir(TEMP_DIR):
-                try:
-                    os.unlink(os.path.join(TEMP_DIR, file))
-                except Exception as e:
-                    logger.info(f'Error removing temporary file {file}: {str(e)}')
-    except Exception as e:
-        logger.info(f'Error cleaning up temporary directory: {str(e)}')
+
+def json_response(body):
+    """Build a JSON response from already serialized bytes"""
+    return app.response_class(body, mimetype='application/json')
 
 
 @app.route('/health', methods=['GET'])
@@ -434,8 +1051,16 @@ def analyze():
 
 @app.route('/api/sast/findings', methods=['GET'])
 def get_findings():
+    global findings_response_cache
+
     try:
-        return jsonify({'items': sast_findings})
+        # Findings only change when scans complete, so reuse the serialized body between polls
+        snapshot = findings_snapshot
+        cached_snapshot, body = findings_response_cache
+        if cached_snapshot is not snapshot:
+            body = orjson.dumps({'items': snapshot})
+            findings_response_cache = (snapshot, body)
+        return json_response(body)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -443,7 +1068,7 @@ def get_findings():
 @app.route('/api/sast/scanning', methods=['GET'])
 def get_scanning():
     try:
-        return jsonify({'items': sast_scanning})
+        return json_response(orjson.dumps({'items': scanning_snapshot}))
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -457,6 +1082,11 @@ def clear():
         return jsonify({'error': str(e)}), 500
 
 
-if __name__ == '__main__':
+# Initialize on import so the service is ready when served by gunicorn as well.
+# Analysis workers import this module too, they're set up by initialize_analysis_worker instead
+if multiprocessing.parent_process() is None:
     initialize_semgrep()
+    threading.Thread(target=reap_scanning_items, name='scanning-reaper', daemon=True).start()
+
+if __name__ == '__main__':
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5002)), debug=False)
\ No newline at end of file
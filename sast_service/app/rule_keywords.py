@@ -0,0 +1,82 @@
+"""
+Keyword extraction from semgrep rules for the SAST prefilter
+Any code a rule matches contains at least one of the rule's keywords, so content with none of them can skip semgrep
+"""
+import re
+
+# Used to pull keywords out of semgrep patterns for the prefilter. Metavariables, including
+# ellipsis metavariables like $...ARGS, are matched whole so their names aren't taken as keywords
+IDENTIFIER_RE = re.compile(r'\$(?:\.\.\.)?[A-Za-z_]\w*|[A-Za-z_]\w*')
+QUOTED_STRING_RE = re.compile(r'"(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|`[^`]*`')
+TYPED_METAVARIABLE_RE = re.compile(r'\(\s*[\w.<>\[\]]+\s+\$\w+\s*\)')
+POSITIVE_PATTERN_KEYS = {'pattern', 'pattern-either', 'patterns', 'pattern-inside'}
+
+
+def get_pattern_keywords(pattern):
+    """
+    Get the identifiers a semgrep pattern can't match without
+    Metavariables, strings and typed metavariables are left out since they don't appear literally in the code
+    """
+    if not isinstance(pattern, str):
+        return None
+
+    pattern = TYPED_METAVARIABLE_RE.sub(' ', pattern)
+    pattern = QUOTED_STRING_RE.sub(' ', pattern)
+    identifiers = [word for word in IDENTIFIER_RE.findall(pattern) if not word.startswith('$')]
+    if not identifiers:
+        return None
+
+    # A single identifier is enough; the longest one is the most selective
+    return {max(identifiers, key=len)}
+
+
+def get_formula_keywords(formula):
+    """
+    Get keywords of which at least one appears in any code matched by a pattern formula
+    Returns None when no such keywords can be found (e.g. pattern-regex), meaning the rule can match anything
+    """
+    if isinstance(formula, str):
+        return get_pattern_keywords(formula)
+    if not isinstance(formula, dict):
+        return None
+
+    if 'pattern' in formula:
+        return get_pattern_keywords(formula['pattern'])
+    if 'pattern-inside' in formula:
+        return get_pattern_keywords(formula['pattern-inside'])
+    if 'pattern-either' in formula:
+        # Any branch can match on its own, so every branch needs keywords
+        keywords = set()
+        for branch in formula['pattern-either'] or []:
+            branch_keywords = get_formula_keywords(branch)
+            if branch_keywords is None:
+                return None
+            keywords |= branch_keywords
+        return keywords or None
+    if 'patterns' in formula:
+        # Every positive pattern has to match, so keywords from any of them will do
+        keywords = set()
+        for child in formula['patterns'] or []:
+            if isinstance(child, dict) and POSITIVE_PATTERN_KEYS.intersection(child):
+                keywords |= get_formula_keywords(child) or set()
+        return keywords or None
+
+    return None
+
+
+def get_rule_keywords(rule):
+    """Get the keywords for a semgrep rule, or None if it can't be prefiltered"""
+    if not isinstance(rule, dict):
+        return None
+
+    if rule.get('mode') == 'taint':
+        # A taint finding is always reported at a sink
+        keywords = set()
+        for sink in rule.get('pattern-sinks') or []:
+            sink_keywords = get_formula_keywords(sink)
+            if sink_keywords is None:
+                return None
+            keywords |= sink_keywords
+        return keywords or None
+
+    return get_formula_keywords(rule)
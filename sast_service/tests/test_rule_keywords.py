@@ -0,0 +1,88 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'app'))
+
+from rule_keywords import get_formula_keywords, get_pattern_keywords, get_rule_keywords  # noqa: E402
+
+
+class GetPatternKeywordsTest(unittest.TestCase):
+    def test_longest_identifier(self):
+        self.assertEqual(get_pattern_keywords('$EL.innerHTML = $X'), {'innerHTML'})
+
+    def test_strings_are_ignored(self):
+        self.assertEqual(get_pattern_keywords('eval("...")'), {'eval'})
+        self.assertIsNone(get_pattern_keywords('"password"'))
+
+    def test_metavariable_only_pattern(self):
+        self.assertIsNone(get_pattern_keywords('$F($X)'))
+
+    def test_ellipsis_metavariable_only_pattern(self):
+        self.assertIsNone(get_pattern_keywords('$FUNC($...ARGUMENTS)'))
+        self.assertIsNone(get_pattern_keywords('$OBJ.$METHOD($...PARAMS)'))
+
+    def test_ellipsis_metavariable_is_not_a_keyword(self):
+        self.assertEqual(get_pattern_keywords('eval($...ARGUMENTS)'), {'eval'})
+
+    def test_typed_metavariable_is_ignored(self):
+        self.assertIsNone(get_pattern_keywords('$F((String $X))'))
+
+    def test_not_a_string(self):
+        self.assertIsNone(get_pattern_keywords(None))
+
+
+class GetFormulaKeywordsTest(unittest.TestCase):
+    def test_pattern_either(self):
+        formula = {'pattern-either': [{'pattern': 'exec($X)'}, {'pattern': 'os.system($X)'}]}
+        self.assertEqual(get_formula_keywords(formula), {'exec', 'system'})
+
+    def test_pattern_either_with_unfilterable_branch(self):
+        formula = {'pattern-either': [{'pattern': 'exec($X)'}, {'pattern': '$F($X)'}]}
+        self.assertIsNone(get_formula_keywords(formula))
+
+    def test_patterns_ignore_pattern_not(self):
+        formula = {'patterns': [
+            {'pattern': 'document.write($X)'},
+            {'pattern-not': 'sanitize($X)'}
+        ]}
+        self.assertEqual(get_formula_keywords(formula), {'document'})
+
+    def test_patterns_with_only_negative_patterns(self):
+        formula = {'patterns': [{'pattern-not': 'sanitize($X)'}]}
+        self.assertIsNone(get_formula_keywords(formula))
+
+    def test_pattern_regex(self):
+        self.assertIsNone(get_formula_keywords({'pattern-regex': 'eval\\('}))
+
+
+class GetRuleKeywordsTest(unittest.TestCase):
+    def test_taint_rule_uses_sinks(self):
+        rule = {
+            'mode': 'taint',
+            'pattern-sources': [{'pattern': '$REQ.query'}],
+            'pattern-sinks': [{'pattern': '$RES.send($X)'}, {'pattern': 'eval($X)'}]
+        }
+        self.assertEqual(get_rule_keywords(rule), {'send', 'eval'})
+
+    def test_taint_rule_with_unfilterable_sink(self):
+        rule = {'mode': 'taint', 'pattern-sinks': [{'pattern': '$F($X)'}]}
+        self.assertIsNone(get_rule_keywords(rule))
+
+    def test_taint_rule_without_sinks(self):
+        self.assertIsNone(get_rule_keywords({'mode': 'taint'}))
+
+    def test_pattern_regex_rule(self):
+        self.assertIsNone(get_rule_keywords({'id': 'x', 'pattern-regex': 'password\\s*='}))
+
+    def test_metavariable_only_rule(self):
+        self.assertIsNone(get_rule_keywords({'id': 'x', 'pattern': '$X == $X'}))
+        self.assertIsNone(get_rule_keywords({'id': 'x', 'pattern': '$OBJ.$METHOD($...PARAMS)'}))
+
+    def test_unknown_syntax(self):
+        self.assertIsNone(get_rule_keywords({'id': 'x', 'match': {'pattern': 'eval($X)'}}))
+        self.assertIsNone(get_rule_keywords('not a rule'))
+
+
+if __name__ == '__main__':
+    unittest.main()